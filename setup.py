@@ -77,6 +77,9 @@ setup(
             "pytest-xdist>=2.2.1",
             "pytest-asyncio>=0.17",
             "beautifulsoup4>=4.8.1",
+            "lxml>=4.6",
+            "orjson>=3.6",
+            "uvloop>=0.16; sys_platform != 'win32'",
             "black==22.12.0",
             "blacken-docs==1.12.1",
             "pytest-timeout>=1.4.2",
@@ -16,6 +16,11 @@ try:
 except ImportError:
     import sqlite3
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 UNDOCUMENTED_PERMISSIONS = {
     "this_is_allowed",
     "this_is_denied",
@@ -38,8 +43,31 @@ def wait_until_responds(url, timeout=5.0, client=httpx, **kwargs):
     raise AssertionError("Timed out waiting for {} to respond".format(url))
 
 
+# Run async tests on the faster uvloop event loop. This is not set as the
+# global event loop policy because the CLI tests rely on
+# asyncio.get_event_loop() creating a loop for the main thread
+if uvloop is not None and hasattr(pytest_asyncio.plugin, "event_loop_policy"):
+    # pytest-asyncio 0.23 and later create loops from this fixture, and
+    # deprecate overriding event_loop
+
+    @pytest.fixture(scope="session")
+    def event_loop_policy():
+        return uvloop.EventLoopPolicy()
+
+elif uvloop is not None:
+
+    @pytest.fixture
+    def event_loop():
+        loop = uvloop.new_event_loop()
+        yield loop
+        loop.close()
+
+
 @pytest_asyncio.fixture
 async def ds_client():
+    # This can't be scope="session" because async fixtures share the event
+    # loop of the test using them - instead the Datasette instance is built
+    # once and cached in _ds_client, so every test shares the same one
     from datasette.app import Datasette
     from .fixtures import METADATA, PLUGINS_DIR
 
@@ -114,13 +142,17 @@ def move_to_front(items, test_name):
         items.insert(0, items.pop(items.index(test[0])))
 
 
-@pytest.fixture
-def restore_working_directory(tmpdir, request):
+def _current_working_directory():
     try:
-        previous_cwd = os.getcwd()
+        return os.getcwd()
     except OSError:
         # https://github.com/simonw/datasette/issues/1361
-        previous_cwd = None
+        return None
+
+
+@pytest.fixture
+def restore_working_directory(tmpdir, request):
+    previous_cwd = _current_working_directory()
     tmpdir.chdir()
 
     def return_to_previous():
@@ -130,6 +162,23 @@ def restore_working_directory(tmpdir, request):
         request.addfinalizer(return_to_previous)
 
 
+@pytest.fixture(scope="module")
+def module_working_directory(tmp_path_factory):
+    """
+    Working directory for a module's tests to return to, restored once the
+    module is finished - falls back to a temporary directory if the current
+    one has already been deleted by an earlier test
+    """
+    previous_cwd = _current_working_directory()
+    cwd = previous_cwd or str(tmp_path_factory.mktemp("cwd"))
+    os.chdir(cwd)
+    try:
+        yield cwd
+    finally:
+        if previous_cwd is not None:
+            os.chdir(previous_cwd)
+
+
 @pytest.fixture(scope="session", autouse=True)
 def check_permission_actions_are_documented():
     from datasette.plugins import pm
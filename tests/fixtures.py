@@ -3,6 +3,7 @@ from datasette.utils.sqlite import sqlite3
 from datasette.utils.testing import TestClient
 import click
 import contextlib
+import functools
 import itertools
 import json
 import os
@@ -14,9 +15,6 @@ import tempfile
 import textwrap
 
 
-# This temp file is used by one of the plugin config tests
-TEMP_PLUGIN_SECRET_FILE = os.path.join(tempfile.gettempdir(), "plugin-secret")
-
 PLUGINS_DIR = str(pathlib.Path(__file__).parent / "plugins")
 
 EXPECTED_PLUGINS = [
@@ -125,13 +123,7 @@ def make_app_client(
         else:
             files = [filepath]
             immutables = []
-        conn = sqlite3.connect(filepath)
-        conn.executescript(TABLES)
-        for sql, params in TABLE_PARAMETERIZED_SQL:
-            with conn:
-                conn.execute(sql, params)
-        # Close the connection to avoid "too many open files" errors
-        conn.close()
+        write_fixtures_database(filepath)
         if extra_databases is not None:
             for extra_filename, extra_sql in extra_databases.items():
                 extra_filepath = os.path.join(tmpdir, extra_filename)
@@ -173,6 +165,26 @@ def make_app_client(
                 db.close()
 
 
+def write_fixtures_database(path):
+    "Write the fixtures tables and rows to a new SQLite database at path"
+    conn = sqlite3.connect(path)
+    _fixtures_database().backup(conn)
+    # Close the connection to avoid "too many open files" errors
+    conn.close()
+
+
+@functools.lru_cache(maxsize=None)
+def _fixtures_database():
+    # Executing TABLES takes around half a second, so build it in memory once
+    # and copy it into each new database file using the SQLite backup API
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    conn.executescript(TABLES)
+    for sql, params in TABLE_PARAMETERIZED_SQL:
+        with conn:
+            conn.execute(sql, params)
+    return conn
+
+
 @pytest.fixture(scope="session")
 def app_client():
     with make_app_client() as client:
@@ -310,7 +322,6 @@ METADATA = {
         "name-of-plugin": {"depth": "root"},
         "env-plugin": {"foo": {"$env": "FOO_ENV"}},
         "env-plugin-list": [{"in_a_list": {"$env": "FOO_ENV"}}],
-        "file-plugin": {"foo": {"$file": TEMP_PLUGIN_SECRET_FILE}},
     },
     "databases": {
         "fixtures": {
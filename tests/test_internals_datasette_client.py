@@ -1,7 +1,13 @@
+import asyncio
 import httpx
 import pytest
 import pytest_asyncio
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 @pytest_asyncio.fixture
 async def datasette(ds_client):
@@ -65,3 +71,12 @@ async def test_client_path(datasette, prefix, expected_path):
         assert path == expected_path
     finally:
         datasette._settings["base_url"] = original_base_url
+
+
+@pytest.mark.skipif(uvloop is None, reason="uvloop is not installed")
+@pytest.mark.asyncio
+async def test_client_runs_on_uvloop(datasette):
+    # tests/conftest.py runs async tests on uvloop whenever it is installed
+    assert isinstance(asyncio.get_running_loop(), uvloop.Loop)
+    response = await datasette.client.get("/")
+    assert response.status_code == 200
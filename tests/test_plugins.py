@@ -1,10 +1,8 @@
-from bs4 import BeautifulSoup as Soup
 from .fixtures import (
     app_client,
     app_client,
     make_app_client,
-    TABLES,
-    TEMP_PLUGIN_SECRET_FILE,
+    write_fixtures_database,
     PLUGINS_DIR,
     TestClient as _TestClient,
 )  # noqa
@@ -16,30 +14,106 @@ from datasette.plugins import get_plugins, DEFAULT_PLUGINS, pm
 from datasette.utils.sqlite import sqlite3
 from datasette.utils import CustomRow, StartupError
 from jinja2.environment import Template
+import asyncio
 import base64
-import importlib
+import functools
+import html
+import importlib.util
 import json
+import orjson
 import os
 import pathlib
 import re
 import textwrap
 import pytest
+import pytest_asyncio
 import urllib
 
+PLUGIN_HOOK_NAMES = tuple(name for name in dir(pm.hook) if not name.startswith("_"))
+
 at_memory_re = re.compile(r" at 0x\w+")
+extra_body_script_re = re.compile(
+    r"<script type=\"module\">var extra_body_script = (.*?);</script>"
+)
+# Captures the base64-encoded JSON blob from the extra-css-urls-demo.css link
+extra_css_urls_demo_re = re.compile(
+    r'href="https://plugin-example\.datasette\.io/([^"]+)/extra-css-urls-demo\.css"'
+)
 
+# The <pre class="extra_..."> blocks rendered by test_templates/show_json.html -
+# their contents are HTML escaped, so use html.unescape() on them
+extra_pre_re = re.compile(r'<pre class="(extra_\w+)">(.*?)</pre>', re.DOTALL)
+col_content_re = re.compile(r'<td class="col-content[^"]*">(.*?)</td>', re.DOTALL)
 
-@pytest.mark.parametrize(
-    "plugin_hook", [name for name in dir(pm.hook) if not name.startswith("_")]
-)
+# lxml is much faster, but fall back to the pure Python parser if it is missing
+soup_parser = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+
+# Parse only when traversing more than one element - a single value can be
+# pulled straight out of the response text with one of the patterns above
+def _soup(content):
+    # Imported here so running only tests that never parse HTML skips bs4
+    from bs4 import BeautifulSoup as Soup
+
+    # Pass response.content so the parser reads the bytes directly, rather
+    # than httpx decoding them to response.text first
+    return Soup(content, soup_parser)
+
+
+@functools.lru_cache(maxsize=None)
+def _selector(css):
+    "Compile a CSS selector once, for reuse across calls of the link helpers"
+    import soupsieve
+
+    return soupsieve.compile(css)
+
+
+# Responses for pages that render the same way every time, keyed by path,
+# and the parsed soup for the ones that a test has needed to traverse
+_page_cache = {}
+_soup_cache = {}
+
+
+@pytest.fixture
+def cached_page(ds_client):
+    "Fetch a page at most once per test session"
+
+    async def get(path):
+        if path not in _page_cache:
+            _page_cache[path] = await ds_client.get(path)
+        return _page_cache[path]
+
+    return get
+
+
+@pytest.fixture
+def cached_soup(cached_page):
+    "Fetch and parse a page at most once per test session"
+
+    async def get(path):
+        if path not in _soup_cache:
+            response = await cached_page(path)
+            _soup_cache[path] = _soup(response.content)
+        return _soup_cache[path]
+
+    return get
+
+
+@functools.lru_cache(maxsize=None)
+def _hooks_with_tests():
+    # Built on first use, by which point every test_hook_* in this module exists
+    tests_in_this_module = [t for t in globals().keys() if t.startswith("test_hook_")]
+    return {
+        plugin_hook: any(plugin_hook in test for test in tests_in_this_module)
+        for plugin_hook in PLUGIN_HOOK_NAMES
+    }
+
+
+@pytest.mark.parametrize("plugin_hook", PLUGIN_HOOK_NAMES)
 def test_plugin_hooks_have_tests(plugin_hook):
     """Every plugin hook should be referenced in this test module"""
-    tests_in_this_module = [t for t in globals().keys() if t.startswith("test_hook_")]
-    ok = False
-    for test in tests_in_this_module:
-        if plugin_hook in test:
-            ok = True
-    assert ok, f"Plugin hook is missing tests: {plugin_hook}"
+    has_tests = _hooks_with_tests()[plugin_hook]
+    assert has_tests, f"Plugin hook is missing tests: {plugin_hook}"
 
 
 @pytest.mark.asyncio
@@ -110,25 +184,18 @@ async def test_hook_plugin_prepare_connection_arguments(ds_client):
         ),
     ],
 )
-async def test_hook_extra_css_urls(ds_client, path, expected_decoded_object):
-    response = await ds_client.get(path)
+async def test_hook_extra_css_urls(cached_page, path, expected_decoded_object):
+    response = await cached_page(path)
     assert response.status_code == 200
-    links = Soup(response.text, "html.parser").findAll("link")
-    special_href = [
-        l for l in links if l.attrs["href"].endswith("/extra-css-urls-demo.css")
-    ][0]["href"]
     # This link has a base64-encoded JSON blob in it
-    encoded = special_href.split("/")[3]
-    assert expected_decoded_object == json.loads(
-        base64.b64decode(encoded).decode("utf8")
-    )
+    encoded = extra_css_urls_demo_re.search(response.text).group(1)
+    assert expected_decoded_object == json.loads(base64.b64decode(encoded))
 
 
 @pytest.mark.asyncio
-async def test_hook_extra_js_urls(ds_client):
-    response = await ds_client.get("/")
-    scripts = Soup(response.text, "html.parser").findAll("script")
-    script_attrs = [s.attrs for s in scripts]
+async def test_hook_extra_js_urls(cached_soup):
+    soup = await cached_soup("/")
+    script_attrs = [s.attrs for s in soup.select("script[src]")]
     for attrs in [
         {
             "integrity": "SRIHASH",
@@ -144,16 +211,15 @@ async def test_hook_extra_js_urls(ds_client):
 
 
 @pytest.mark.asyncio
-async def test_plugins_with_duplicate_js_urls(ds_client):
+async def test_plugins_with_duplicate_js_urls(cached_soup):
     # If two plugins both require jQuery, jQuery should be loaded only once
-    response = await ds_client.get("/fixtures")
+    soup = await cached_soup("/fixtures")
     # This test is a little tricky, as if the user has any other plugins in
     # their current virtual environment those may affect what comes back too.
     # What matters is that https://plugin-example.datasette.io/jquery.js is only there once
     # and it comes before plugin1.js and plugin2.js which could be in either
     # order
-    scripts = Soup(response.text, "html.parser").findAll("script")
-    srcs = [s["src"] for s in scripts if s.get("src")]
+    srcs = [s["src"] for s in soup.select("script[src]")]
     # No duplicates allowed:
     assert len(srcs) == len(set(srcs))
     # jquery.js loaded once:
@@ -177,8 +243,7 @@ async def test_hook_render_cell_link_from_json(ds_client):
     """.strip()
     path = "/fixtures?" + urllib.parse.urlencode({"sql": sql})
     response = await ds_client.get(path)
-    td = Soup(response.text, "html.parser").find("table").find("tbody").find("td")
-    a = td.find("a")
+    a = _soup(response.content).select_one("table tbody td a")
     assert a is not None, str(a)
     assert a.attrs["href"] == "http://example.com/"
     assert a.attrs["data-database"] == "fixtures"
@@ -188,9 +253,8 @@ async def test_hook_render_cell_link_from_json(ds_client):
 @pytest.mark.asyncio
 async def test_hook_render_cell_demo(ds_client):
     response = await ds_client.get("/fixtures/simple_primary_key?id=4")
-    soup = Soup(response.text, "html.parser")
-    td = soup.find("td", {"class": "col-content"})
-    assert json.loads(td.string) == {
+    td_content = html.unescape(col_content_re.search(response.text).group(1))
+    assert orjson.loads(td_content) == {
         "row": {"id": "4", "content": "RENDER_CELL_DEMO"},
         "column": "content",
         "table": "simple_primary_key",
@@ -227,18 +291,17 @@ async def test_plugin_config(ds_client):
 
 
 @pytest.mark.asyncio
-async def test_plugin_config_env(ds_client):
-    os.environ["FOO_ENV"] = "FROM_ENVIRONMENT"
+async def test_plugin_config_env(ds_client, monkeypatch):
+    monkeypatch.setenv("FOO_ENV", "FROM_ENVIRONMENT")
     assert {"foo": "FROM_ENVIRONMENT"} == ds_client.ds.plugin_config("env-plugin")
     # Ensure secrets aren't visible in /-/metadata.json
     metadata = await ds_client.get("/-/metadata.json")
     assert {"foo": {"$env": "FOO_ENV"}} == metadata.json()["plugins"]["env-plugin"]
-    del os.environ["FOO_ENV"]
 
 
 @pytest.mark.asyncio
-async def test_plugin_config_env_from_list(ds_client):
-    os.environ["FOO_ENV"] = "FROM_ENVIRONMENT"
+async def test_plugin_config_env_from_list(ds_client, monkeypatch):
+    monkeypatch.setenv("FOO_ENV", "FROM_ENVIRONMENT")
     assert [{"in_a_list": "FROM_ENVIRONMENT"}] == ds_client.ds.plugin_config(
         "env-plugin-list"
     )
@@ -247,22 +310,26 @@ async def test_plugin_config_env_from_list(ds_client):
     assert [{"in_a_list": {"$env": "FOO_ENV"}}] == metadata.json()["plugins"][
         "env-plugin-list"
     ]
-    del os.environ["FOO_ENV"]
 
 
 @pytest.mark.asyncio
-async def test_plugin_config_file(ds_client):
-    with open(TEMP_PLUGIN_SECRET_FILE, "w") as fp:
-        fp.write("FROM_FILE")
+async def test_plugin_config_file(ds_client, tmp_path, monkeypatch):
+    secret_file = tmp_path / "plugin-secret"
+    secret_file.write_text("FROM_FILE")
+    monkeypatch.setitem(
+        ds_client.ds._metadata_local["plugins"],
+        "file-plugin",
+        {"foo": {"$file": str(secret_file)}},
+    )
     assert {"foo": "FROM_FILE"} == ds_client.ds.plugin_config("file-plugin")
     # Ensure secrets aren't visible in /-/metadata.json
     metadata = await ds_client.get("/-/metadata.json")
-    assert {"foo": {"$file": TEMP_PLUGIN_SECRET_FILE}} == metadata.json()["plugins"][
+    assert {"foo": {"$file": str(secret_file)}} == metadata.json()["plugins"][
         "file-plugin"
     ]
-    os.remove(TEMP_PLUGIN_SECRET_FILE)
 
 
+@pytest.mark.asyncio
 @pytest.mark.parametrize(
     "path,expected_extra_body_script",
     [
@@ -315,10 +382,10 @@ async def test_plugin_config_file(ds_client):
         ),
     ],
 )
-def test_hook_extra_body_script(app_client, path, expected_extra_body_script):
-    r = re.compile(r"<script type=\"module\">var extra_body_script = (.*?);</script>")
-    json_data = r.search(app_client.get(path).text).group(1)
-    actual_data = json.loads(json_data)
+async def test_hook_extra_body_script(cached_page, path, expected_extra_body_script):
+    response = await cached_page(path)
+    json_data = extra_body_script_re.search(response.text).group(1)
+    actual_data = orjson.loads(json_data)
     assert expected_extra_body_script == actual_data
 
 
@@ -334,8 +401,9 @@ def test_hook_extra_template_vars(restore_working_directory):
     ) as client:
         response = client.get("/-/metadata")
         assert response.status_code == 200
+        pre_blocks = dict(extra_pre_re.findall(response.text))
         extra_template_vars = json.loads(
-            Soup(response.text, "html.parser").select("pre.extra_template_vars")[0].text
+            html.unescape(pre_blocks["extra_template_vars"])
         )
         assert {
             "template": "show_json.html",
@@ -343,9 +411,7 @@ def test_hook_extra_template_vars(restore_working_directory):
             "columns": None,
         } == extra_template_vars
         extra_template_vars_from_awaitable = json.loads(
-            Soup(response.text, "html.parser")
-            .select("pre.extra_template_vars_from_awaitable")[0]
-            .text
+            html.unescape(pre_blocks["extra_template_vars_from_awaitable"])
         )
         assert {
             "template": "show_json.html",
@@ -360,15 +426,11 @@ def test_plugins_async_template_function(restore_working_directory):
     ) as client:
         response = client.get("/-/metadata")
         assert response.status_code == 200
-        extra_from_awaitable_function = (
-            Soup(response.text, "html.parser")
-            .select("pre.extra_from_awaitable_function")[0]
-            .text
-        )
+        pre_blocks = dict(extra_pre_re.findall(response.text))
         expected = (
             sqlite3.connect(":memory:").execute("select sqlite_version()").fetchone()[0]
         )
-        assert expected == extra_from_awaitable_function
+        assert expected == html.unescape(pre_blocks["extra_from_awaitable_function"])
 
 
 def test_default_plugins_have_no_templates_path_or_static_path():
@@ -409,8 +471,7 @@ def view_names_client(tmp_path_factory):
         "utf-8",
     )
     db_path = str(tmpdir / "fixtures.db")
-    conn = sqlite3.connect(db_path)
-    conn.executescript(TABLES)
+    write_fixtures_database(db_path)
     return _TestClient(
         Datasette([db_path], template_dir=str(templates), plugins_dir=str(plugins))
     )
@@ -446,8 +507,10 @@ async def test_hook_register_output_renderer_all_parameters(ds_client):
     assert response.status_code == 200
     # Lots of 'at 0x103a4a690' in here - replace those so we can do
     # an easy comparison
-    body = at_memory_re.sub(" at 0xXXX", response.text)
-    assert json.loads(body) == {
+    data = orjson.loads(response.content)
+    data["datasette"] = at_memory_re.sub(" at 0xXXX", data["datasette"])
+    data["rows"] = [at_memory_re.sub(" at 0xXXX", row) for row in data["rows"]]
+    assert data == {
         "datasette": "<datasette.app.Datasette object at 0xXXX>",
         "columns": [
             "pk",
@@ -493,28 +556,18 @@ async def test_hook_register_output_renderer_all_parameters(ds_client):
 
 
 @pytest.mark.asyncio
-async def test_hook_register_output_renderer_custom_status_code(ds_client):
-    response = await ds_client.get(
-        "/fixtures/pragma_cache_size.testall?status_code=202"
-    )
-    assert response.status_code == 202
-
-
-@pytest.mark.asyncio
-async def test_hook_register_output_renderer_custom_content_type(ds_client):
-    response = await ds_client.get(
-        "/fixtures/pragma_cache_size.testall?content_type=text/blah"
-    )
-    assert "text/blah" == response.headers["content-type"]
-
-
-@pytest.mark.asyncio
-async def test_hook_register_output_renderer_custom_headers(ds_client):
-    response = await ds_client.get(
-        "/fixtures/pragma_cache_size.testall?header=x-wow:1&header=x-gosh:2"
+async def test_hook_register_output_renderer_custom_response(ds_client):
+    status_response, content_type_response, headers_response = await asyncio.gather(
+        ds_client.get("/fixtures/pragma_cache_size.testall?status_code=202"),
+        ds_client.get("/fixtures/pragma_cache_size.testall?content_type=text/blah"),
+        ds_client.get(
+            "/fixtures/pragma_cache_size.testall?header=x-wow:1&header=x-gosh:2"
+        ),
     )
-    assert "1" == response.headers["x-wow"]
-    assert "2" == response.headers["x-gosh"]
+    assert status_response.status_code == 202
+    assert "text/blah" == content_type_response.headers["content-type"]
+    assert "1" == headers_response.headers["x-wow"]
+    assert "2" == headers_response.headers["x-gosh"]
 
 
 @pytest.mark.asyncio
@@ -535,11 +588,7 @@ async def test_hook_register_output_renderer_returning_broken_value(ds_client):
 async def test_hook_register_output_renderer_can_render(ds_client):
     response = await ds_client.get("/fixtures/facetable?_no_can_render=1")
     assert response.status_code == 200
-    links = (
-        Soup(response.text, "html.parser")
-        .find("p", {"class": "export-links"})
-        .findAll("a")
-    )
+    links = _soup(response.content).select("p.export-links a")
     actual = [l["href"] for l in links]
     # Should not be present because we sent ?_no_can_render=1
     assert "/fixtures/facetable.testall?_labels=on" not in actual
@@ -821,22 +870,18 @@ async def test_hook_canned_queries(ds_client):
 
 
 @pytest.mark.asyncio
-async def test_hook_canned_queries_non_async(ds_client):
-    response = await ds_client.get("/fixtures/from_hook.json?_shape=array")
-    assert [{"1": 1, "actor_id": "null"}] == response.json()
-
-
-@pytest.mark.asyncio
-async def test_hook_canned_queries_async(ds_client):
-    response = await ds_client.get("/fixtures/from_async_hook.json?_shape=array")
-    assert [{"2": 2}] == response.json()
-
-
-@pytest.mark.asyncio
-async def test_hook_canned_queries_actor(ds_client):
-    assert (
-        await ds_client.get("/fixtures/from_hook.json?_bot=1&_shape=array")
-    ).json() == [{"1": 1, "actor_id": "bot"}]
+async def test_hook_canned_queries_execute(ds_client):
+    non_async_response, async_response = await asyncio.gather(
+        ds_client.get("/fixtures/from_hook.json?_shape=array"),
+        ds_client.get("/fixtures/from_async_hook.json?_shape=array"),
+    )
+    assert [{"1": 1, "actor_id": "null"}] == non_async_response.json()
+    assert [{"2": 2}] == async_response.json()
+    # Not run alongside the others: get_canned_queries() updates the queries
+    # dictionary from metadata in place, so concurrent requests from
+    # different actors can see each other's from_hook SQL
+    actor_response = await ds_client.get("/fixtures/from_hook.json?_bot=1&_shape=array")
+    assert [{"1": 1, "actor_id": "bot"}] == actor_response.json()
 
 
 def test_hook_register_magic_parameters(restore_working_directory):
@@ -869,153 +914,195 @@ def test_hook_register_magic_parameters(restore_working_directory):
         assert 4 == new_uuid.count("-")
 
 
-def test_hook_forbidden(restore_working_directory):
+@pytest.fixture(scope="module")
+def forbidden_client(module_working_directory):
     with make_app_client(
         extra_databases={"data2.db": "create table logs (line text)"},
         metadata={"allow": {}},
     ) as client:
-        response = client.get("/")
-        assert response.status_code == 403
-        response2 = client.get("/data2")
-        assert 302 == response2.status
-        assert (
-            response2.headers["Location"]
-            == "/login?message=You do not have permission to view this database"
-        )
-        assert (
-            client.ds._last_forbidden_message
-            == "You do not have permission to view this database"
-        )
+        # make_app_client() changes into its temporary directory - change
+        # back so the rest of this module does not run from inside it
+        os.chdir(module_working_directory)
+        yield client
+
+
+@pytest.mark.parametrize(
+    "path,expected_status,expected_message",
+    (
+        ("/", 403, "view-instance"),
+        ("/data2", 302, "You do not have permission to view this database"),
+    ),
+)
+def test_hook_forbidden(forbidden_client, path, expected_status, expected_message):
+    response = forbidden_client.get(path)
+    assert response.status == expected_status
+    if expected_status == 302:
+        assert response.headers["Location"] == "/login?message=" + expected_message
+    assert forbidden_client.ds._last_forbidden_message == expected_message
 
 
 @pytest.mark.asyncio
 async def test_hook_handle_exception(ds_client):
-    await ds_client.get("/trigger-error?x=123")
-    assert hasattr(ds_client.ds, "_exception_hook_fired")
-    request, exception = ds_client.ds._exception_hook_fired
-    assert request.url == "http://localhost/trigger-error?x=123"
-    assert isinstance(exception, ZeroDivisionError)
+    try:
+        await ds_client.get("/trigger-error?x=123")
+        assert hasattr(ds_client.ds, "_exception_hook_fired")
+        request, exception = ds_client.ds._exception_hook_fired
+        assert request.url == "http://localhost/trigger-error?x=123"
+        assert isinstance(exception, ZeroDivisionError)
+    finally:
+        # ds_client is shared by the whole session
+        if hasattr(ds_client.ds, "_exception_hook_fired"):
+            del ds_client.ds._exception_hook_fired
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("param", ("_custom_error", "_custom_error_async"))
+@pytest.mark.parametrize(
+    "param",
+    (
+        pytest.param("_custom_error", id="sync", marks=pytest.mark.fast),
+        pytest.param("_custom_error_async", id="async"),
+    ),
+)
 async def test_hook_handle_exception_custom_response(ds_client, param):
     response = await ds_client.get("/trigger-error?{}=1".format(param))
     assert response.text == param
 
 
-@pytest.mark.asyncio
-async def test_hook_menu_links(ds_client):
-    def get_menu_links(html):
-        soup = Soup(html, "html.parser")
-        return [
-            {"label": a.text, "href": a["href"]} for a in soup.select(".nav-menu a")
-        ]
-
-    response = await ds_client.get("/")
-    assert get_menu_links(response.text) == []
-
-    response_2 = await ds_client.get("/?_bot=1&_hello=BOB")
-    assert get_menu_links(response_2.text) == [
-        {"label": "Hello, BOB", "href": "/"},
-        {"label": "Hello 2", "href": "/"},
+def _menu_links(content):
+    soup = _soup(content)
+    return [
+        {"label": a.text, "href": a["href"]}
+        for a in _selector(".nav-menu a").select(soup)
     ]
 
 
-@pytest.mark.asyncio
-@pytest.mark.parametrize("table_or_view", ["facetable", "simple_view"])
-async def test_hook_table_actions(ds_client, table_or_view):
-    def get_table_actions_links(html):
-        soup = Soup(html, "html.parser")
-        details = soup.find("details", {"class": "actions-menu-links"})
-        if details is None:
-            return []
-        return [{"label": a.text, "href": a["href"]} for a in details.select("a")]
-
-    response = await ds_client.get(f"/fixtures/{table_or_view}")
-    assert get_table_actions_links(response.text) == []
-
-    response_2 = await ds_client.get(f"/fixtures/{table_or_view}?_bot=1&_hello=BOB")
-    assert sorted(
-        get_table_actions_links(response_2.text), key=lambda l: l["label"]
-    ) == [
-        {"label": "Database: fixtures", "href": "/"},
-        {"label": "From async BOB", "href": "/"},
-        {"label": f"Table: {table_or_view}", "href": "/"},
-    ]
+def _actions_menu_links(content):
+    soup = _soup(content)
+    details = soup.find("details", {"class": "actions-menu-links"})
+    if details is None:
+        return []
+    # Plugin hook order is not guaranteed, so sort the links by label
+    return sorted(
+        [{"label": a.text, "href": a["href"]} for a in _selector("a").select(details)],
+        key=lambda link: link["label"],
+    )
 
 
 @pytest.mark.asyncio
-async def test_hook_database_actions(ds_client):
-    def get_table_actions_links(html):
-        soup = Soup(html, "html.parser")
-        details = soup.find("details", {"class": "actions-menu-links"})
-        if details is None:
-            return []
-        return [{"label": a.text, "href": a["href"]} for a in details.select("a")]
+@pytest.mark.parametrize(
+    "path,extract,expected",
+    (
+        pytest.param("/", _menu_links, [], id="menu_links"),
+        pytest.param(
+            "/?_bot=1&_hello=BOB",
+            _menu_links,
+            [
+                {"label": "Hello, BOB", "href": "/"},
+                {"label": "Hello 2", "href": "/"},
+            ],
+            id="menu_links-bot",
+        ),
+        pytest.param(
+            "/fixtures/facetable", _actions_menu_links, [], id="table_actions"
+        ),
+        pytest.param(
+            "/fixtures/facetable?_bot=1&_hello=BOB",
+            _actions_menu_links,
+            [
+                {"label": "Database: fixtures", "href": "/"},
+                {"label": "From async BOB", "href": "/"},
+                {"label": "Table: facetable", "href": "/"},
+            ],
+            id="table_actions-bot",
+        ),
+        pytest.param(
+            "/fixtures/simple_view", _actions_menu_links, [], id="view_actions"
+        ),
+        pytest.param(
+            "/fixtures/simple_view?_bot=1&_hello=BOB",
+            _actions_menu_links,
+            [
+                {"label": "Database: fixtures", "href": "/"},
+                {"label": "From async BOB", "href": "/"},
+                {"label": "Table: simple_view", "href": "/"},
+            ],
+            id="view_actions-bot",
+        ),
+        pytest.param("/fixtures", _actions_menu_links, [], id="database_actions"),
+        pytest.param(
+            "/fixtures?_bot=1&_hello=BOB",
+            _actions_menu_links,
+            [{"label": "Database: fixtures - BOB", "href": "/"}],
+            id="database_actions-bot",
+        ),
+    ),
+)
+async def test_hook_menu_links_table_actions_database_actions(
+    ds_client, path, extract, expected
+):
+    response = await ds_client.get(path)
+    assert extract(response.content) == expected
 
-    response = await ds_client.get("/fixtures")
-    assert get_table_actions_links(response.text) == []
 
-    response_2 = await ds_client.get("/fixtures?_bot=1&_hello=BOB")
-    assert get_table_actions_links(response_2.text) == [
-        {"label": "Database: fixtures - BOB", "href": "/"},
-    ]
+@pytest.fixture(scope="module")
+def actor_cookie(app_client):
+    return app_client.actor_cookie({"id": "test"})
 
 
-def test_hook_skip_csrf(app_client):
-    cookie = app_client.actor_cookie({"id": "test"})
+def test_hook_skip_csrf_with_token(app_client, actor_cookie):
     csrf_response = app_client.post(
         "/post/",
         post_data={"this is": "post data"},
         csrftoken_from=True,
-        cookies={"ds_actor": cookie},
+        cookies={"ds_actor": actor_cookie},
     )
     assert csrf_response.status_code == 200
-    missing_csrf_response = app_client.post(
-        "/post/", post_data={"this is": "post data"}, cookies={"ds_actor": cookie}
-    )
-    assert missing_csrf_response.status_code == 403
-    # But "/skip-csrf" should allow
-    allow_csrf_response = app_client.post(
-        "/skip-csrf", post_data={"this is": "post data"}, cookies={"ds_actor": cookie}
-    )
-    assert allow_csrf_response.status_code == 405  # Method not allowed
-    # /skip-csrf-2 should not
-    second_missing_csrf_response = app_client.post(
-        "/skip-csrf-2", post_data={"this is": "post data"}, cookies={"ds_actor": cookie}
+
+
+@pytest.mark.parametrize(
+    "path,expected_status",
+    (
+        # Missing CSRF token
+        ("/post/", 403),
+        # But "/skip-csrf" should allow - 405 is method not allowed
+        ("/skip-csrf", 405),
+        # /skip-csrf-2 should not
+        ("/skip-csrf-2", 403),
+    ),
+)
+def test_hook_skip_csrf(app_client, actor_cookie, path, expected_status):
+    response = app_client.post(
+        path, post_data={"this is": "post data"}, cookies={"ds_actor": actor_cookie}
     )
-    assert second_missing_csrf_response.status_code == 403
+    assert response.status_code == expected_status
 
 
 @pytest.mark.asyncio
-async def test_hook_get_metadata(ds_client):
-    try:
-        orig_metadata = ds_client.ds._metadata_local
-        ds_client.ds._metadata_local = {
+async def test_hook_get_metadata(ds_client, monkeypatch):
+    monkeypatch.setattr(
+        ds_client.ds,
+        "_metadata_local",
+        {
             "title": "Testing get_metadata hook!",
             "databases": {"from-local": {"title": "Hello from local metadata"}},
-        }
-        og_pm_hook_get_metadata = pm.hook.get_metadata
+        },
+    )
 
-        def get_metadata_mock(*args, **kwargs):
-            return [
-                {
-                    "databases": {
-                        "from-hook": {"title": "Hello from the plugin hook"},
-                        "from-local": {"title": "This will be overwritten!"},
-                    }
+    def get_metadata_mock(*args, **kwargs):
+        return [
+            {
+                "databases": {
+                    "from-hook": {"title": "Hello from the plugin hook"},
+                    "from-local": {"title": "This will be overwritten!"},
                 }
-            ]
+            }
+        ]
 
-        pm.hook.get_metadata = get_metadata_mock
-        meta = ds_client.ds.metadata()
-        assert "Testing get_metadata hook!" == meta["title"]
-        assert "Hello from local metadata" == meta["databases"]["from-local"]["title"]
-        assert "Hello from the plugin hook" == meta["databases"]["from-hook"]["title"]
-        pm.hook.get_metadata = og_pm_hook_get_metadata
-    finally:
-        ds_client.ds._metadata_local = orig_metadata
+    monkeypatch.setattr(pm.hook, "get_metadata", get_metadata_mock)
+    meta = ds_client.ds.metadata()
+    assert "Testing get_metadata hook!" == meta["title"]
+    assert "Hello from local metadata" == meta["databases"]["from-local"]["title"]
+    assert "Hello from the plugin hook" == meta["databases"]["from-hook"]["title"]
 
 
 def _extract_commands(output):
@@ -1023,23 +1110,14 @@ def _extract_commands(output):
     return {line.split()[0].replace("*", "") for line in lines if line.strip()}
 
 
-def test_hook_register_commands():
-    # Without the plugin should have seven commands
-    runner = CliRunner()
-    result = runner.invoke(cli.cli, "--help")
-    commands = _extract_commands(result.output)
-    assert commands == {
-        "serve",
-        "inspect",
-        "install",
-        "package",
-        "plugins",
-        "publish",
-        "uninstall",
-        "create-token",
-    }
+@pytest.fixture(scope="session")
+def baseline_cli_commands():
+    "Commands listed by datasette --help before any test plugins add to them"
+    return _extract_commands(CliRunner().invoke(cli.cli, "--help").output)
+
 
-    # Now install a plugin
+def test_hook_register_commands(baseline_cli_commands):
+    # Install a plugin that adds two commands
     class VerifyPlugin:
         __name__ = "VerifyPlugin"
 
@@ -1054,68 +1132,105 @@ def test_hook_register_commands():
                 pass
 
     pm.register(VerifyPlugin(), name="verify")
-    importlib.reload(cli)
-    result2 = runner.invoke(cli.cli, "--help")
-    commands2 = _extract_commands(result2.output)
-    assert commands2 == {
-        "serve",
-        "inspect",
-        "install",
-        "package",
-        "plugins",
-        "publish",
-        "uninstall",
-        "verify",
-        "unverify",
-        "create-token",
-    }
-    pm.unregister(name="verify")
-    importlib.reload(cli)
+    try:
+        importlib.reload(cli)
+        result2 = CliRunner().invoke(cli.cli, "--help")
+        after = _extract_commands(result2.output)
+        assert after - baseline_cli_commands == {"verify", "unverify"}
+        assert baseline_cli_commands - after == set()
+    finally:
+        pm.unregister(name="verify")
+        cli.cli.commands.pop("verify", None)
+        cli.cli.commands.pop("unverify", None)
 
 
-@pytest.mark.asyncio
-async def test_hook_filters_from_request(ds_client):
-    class ReturnNothingPlugin:
-        __name__ = "ReturnNothingPlugin"
+class ReturnNothingPlugin:
+    __name__ = "ReturnNothingPlugin"
+
+    @hookimpl
+    def filters_from_request(self, request):
+        if request.args.get("_nothing"):
+            return FilterArguments(["1 = 0"], human_descriptions=["NOTHING"])
 
-        @hookimpl
-        def filters_from_request(self, request):
-            if request.args.get("_nothing"):
-                return FilterArguments(["1 = 0"], human_descriptions=["NOTHING"])
 
+@pytest.fixture
+def return_nothing_plugin():
     pm.register(ReturnNothingPlugin(), name="ReturnNothingPlugin")
-    response = await ds_client.get("/fixtures/facetable?_nothing=1")
-    assert "0 rows\n        where NOTHING" in response.text
-    json_response = await ds_client.get("/fixtures/facetable.json?_nothing=1")
-    assert json_response.json()["rows"] == []
+    yield
     pm.unregister(name="ReturnNothingPlugin")
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("extra_metadata", (False, True))
-async def test_hook_register_permissions(extra_metadata):
-    ds = Datasette(
+async def test_hook_filters_from_request(ds_client, return_nothing_plugin):
+    response, json_response = await asyncio.gather(
+        ds_client.get("/fixtures/facetable?_nothing=1"),
+        ds_client.get("/fixtures/facetable.json?_nothing=1"),
+    )
+    assert "0 rows\n        where NOTHING" in response.text
+    assert json_response.json()["rows"] == []
+
+
+def _perm(name, abbr):
+    return {
+        "name": name,
+        "abbr": abbr,
+        "description": None,
+        "takes_database": False,
+        "takes_resource": False,
+        "default": True,
+    }
+
+
+def _register_permissions_datasette(permissions):
+    return Datasette(
         metadata={
-            "plugins": {
-                "datasette-register-permissions": {
-                    "permissions": [
-                        {
-                            "name": "extra-from-metadata",
-                            "abbr": "efm",
-                            "description": "Extra from metadata",
-                            "takes_database": False,
-                            "takes_resource": False,
-                            "default": True,
-                        }
-                    ]
-                }
-            }
+            "plugins": {"datasette-register-permissions": {"permissions": permissions}}
         }
-        if extra_metadata
+        if permissions
         else None,
         plugins_dir=PLUGINS_DIR,
     )
+
+
+@pytest_asyncio.fixture
+async def ds_with_permissions(request):
+    "Started Datasette with request.param as datasette-register-permissions"
+    ds = _register_permissions_datasette(request.param)
     await ds.invoke_startup()
+    return ds
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "ds_with_permissions,expected_extra",
+    [
+        pytest.param(None, None, id="plain"),
+        pytest.param(
+            [
+                {
+                    "name": "extra-from-metadata",
+                    "abbr": "efm",
+                    "description": "Extra from metadata",
+                    "takes_database": False,
+                    "takes_resource": False,
+                    "default": True,
+                }
+            ],
+            Permission(
+                name="extra-from-metadata",
+                abbr="efm",
+                description="Extra from metadata",
+                takes_database=False,
+                takes_resource=False,
+                default=True,
+            ),
+            id="extra",
+        ),
+    ],
+    indirect=["ds_with_permissions"],
+)
+async def test_hook_register_permissions(ds_with_permissions, expected_extra):
+    ds = ds_with_permissions
     assert ds.permissions["permission-from-plugin"] == Permission(
         name="permission-from-plugin",
         abbr="np",
@@ -1124,90 +1239,57 @@ async def test_hook_register_permissions(extra_metadata):
         takes_resource=False,
         default=False,
     )
-    if extra_metadata:
-        assert ds.permissions["extra-from-metadata"] == Permission(
-            name="extra-from-metadata",
-            abbr="efm",
-            description="Extra from metadata",
-            takes_database=False,
-            takes_resource=False,
-            default=True,
-        )
-    else:
-        assert "extra-from-metadata" not in ds.permissions
+    assert ds.permissions.get("extra-from-metadata") == expected_extra
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("duplicate", ("name", "abbr"))
-async def test_hook_register_permissions_no_duplicates(duplicate):
-    name1, name2 = "name1", "name2"
-    abbr1, abbr2 = "abbr1", "abbr2"
-    if duplicate == "name":
-        name2 = "name1"
-    if duplicate == "abbr":
-        abbr2 = "abbr1"
-    ds = Datasette(
-        metadata={
-            "plugins": {
-                "datasette-register-permissions": {
-                    "permissions": [
-                        {
-                            "name": name1,
-                            "abbr": abbr1,
-                            "description": None,
-                            "takes_database": False,
-                            "takes_resource": False,
-                            "default": True,
-                        },
-                        {
-                            "name": name2,
-                            "abbr": abbr2,
-                            "description": None,
-                            "takes_database": False,
-                            "takes_resource": False,
-                            "default": True,
-                        },
-                    ]
-                }
-            }
-        },
-        plugins_dir=PLUGINS_DIR,
+@pytest.mark.parametrize(
+    "ds_with_permissions",
+    [[_perm("name1", "abbr1"), _perm("name1", "abbr1")]],
+    indirect=True,
+)
+async def test_hook_register_permissions_allows_identical_duplicates(
+    ds_with_permissions,
+):
+    ds = ds_with_permissions
+    assert ds.permissions["name1"] == Permission(
+        name="name1",
+        abbr="abbr1",
+        description=None,
+        takes_database=False,
+        takes_resource=False,
+        default=True,
     )
-    # This should error:
-    with pytest.raises(StartupError) as ex:
-        await ds.invoke_startup()
-        assert "Duplicate permission {}".format(duplicate) in str(ex.value)
+    # Check that ds.permissions has only one of each
+    assert len([p for p in ds.permissions.values() if p.abbr == "abbr1"]) == 1
 
 
 @pytest.mark.asyncio
-async def test_hook_register_permissions_allows_identical_duplicates():
-    ds = Datasette(
-        metadata={
-            "plugins": {
-                "datasette-register-permissions": {
-                    "permissions": [
-                        {
-                            "name": "name1",
-                            "abbr": "abbr1",
-                            "description": None,
-                            "takes_database": False,
-                            "takes_resource": False,
-                            "default": True,
-                        },
-                        {
-                            "name": "name1",
-                            "abbr": "abbr1",
-                            "description": None,
-                            "takes_database": False,
-                            "takes_resource": False,
-                            "default": True,
-                        },
-                    ]
-                }
-            }
-        },
-        plugins_dir=PLUGINS_DIR,
-    )
-    await ds.invoke_startup()
-    # Check that ds.permissions has only one of each
-    assert len([p for p in ds.permissions.values() if p.abbr == "abbr1"]) == 1
+@pytest.mark.parametrize(
+    "permissions,duplicate",
+    [
+        pytest.param(
+            [
+                _perm("name1", "abbr1"),
+                _perm("name1", "abbr2"),
+            ],
+            "name",
+            id="dup-name",
+        ),
+        pytest.param(
+            [
+                _perm("name1", "abbr1"),
+                _perm("name2", "abbr1"),
+            ],
+            "abbr",
+            id="dup-abbr",
+        ),
+    ],
+)
+async def test_hook_register_permissions_no_duplicates(permissions, duplicate):
+    ds = _register_permissions_datasette(permissions)
+    expected = "Duplicate permission {}".format(duplicate)
+    # This should error:
+    with pytest.raises(StartupError) as ex:
+        await ds.invoke_startup()
+    assert expected in str(ex.value)